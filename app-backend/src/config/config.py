@@ -4,4 +4,16 @@ from dataclasses import dataclass
 class Config:
     S3_BUCKET_NAME: str = "the-universal-agent"
 
+    ## Code sandbox limits
+    SANDBOX_MAX_MEMORY_MB: int = 1024       # data segment of the kernel process
+    SANDBOX_MAX_CPU_SECONDS: int = 60       # CPU time of the kernel process
+    SANDBOX_MAX_FILE_SIZE_MB: int = 50      # size of the files the code can write
+    SANDBOX_OUTPUT_HEAD_CHARS: int = 4000   # first characters of stdout/stderr kept for the LLM
+    SANDBOX_OUTPUT_TAIL_CHARS: int = 4000   # last characters of stdout/stderr kept for the LLM
+    SANDBOX_SPILL_MAX_MB: int = 20          # full output kept on disk and offloaded to S3 when truncated
+    SANDBOX_MAX_IMAGE_MB: int = 10          # larger images are refused, kernel messages are capped just above it
+    SANDBOX_MAX_IMAGES: int = 10            # images offloaded per execution, the next ones are ignored
+    SANDBOX_MAX_WALL_SECONDS: int = 120     # upper bound of the `timeout` given by the LLM
+    SANDBOX_RECEIVE_HWM: int = 4            # kernel messages queued per client socket (each one at most a max size image)
+
 CONFIG = Config()
\ No newline at end of file
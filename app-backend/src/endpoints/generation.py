@@ -18,6 +18,8 @@ from schema.generation_streaming import (
 
 import base64
 from rag.server import graph, checkpointer
+from rag.compaction import COMPACTION_TAG, CLIENT_HISTORY_PREFIX
+from rag.speculation import prefetcher
 from uuid import uuid4
 import time
 
@@ -52,7 +54,8 @@ def convert_history(history_items):
     messages = []
     for item in history_items:
         cls = role_map.get(item.role, HumanMessage)  # fallback user
-        messages.append(cls(content=item.content))
+        # Marked so that history compaction drops them instead of summarizing them
+        messages.append(cls(content=item.content, id=CLIENT_HISTORY_PREFIX + str(uuid4())))
     return messages
 
 
@@ -66,6 +69,9 @@ def _create_event_stream(request_id: str, generation):
         try:
             async for chunk in generation:
                 print("event stream chunk:", chunk.get("event"), flush=True)
+                if COMPACTION_TAG in chunk.get("tags", []):
+                    # history summarization runs are internal, never sent to the client
+                    continue
 
                 if chunk.get("event") == "on_chat_model_start":
                     # print("Chat model started:", chunk, flush=True)
@@ -112,6 +118,7 @@ def _create_event_stream(request_id: str, generation):
         
         finally:
             checkpointer.delete_thread(request_id)
+            prefetcher.discard(request_id)
             yield f"data: [DONE]\n\n"      
     
     return event_stream
@@ -3,7 +3,7 @@ import boto3
 from botocore.exceptions import NoCredentialsError
 from models.s3.utils import generate_s3_object_name
 
-from typing import Literal
+from typing import Literal, BinaryIO
 from dotenv import load_dotenv
 from config.config import CONFIG
 load_dotenv()
@@ -13,17 +13,17 @@ load_dotenv()
 # }
 
 
-def upload_files_to_s3(file_content: bytes, file_name: str, content_type: str = "text/plain", role: Literal["upload", "generation"]= "upload") -> str | None:
+def upload_files_to_s3(file_content: bytes | BinaryIO, file_name: str, content_type: str = "text/plain", role: Literal["upload", "generation"]= "upload") -> str | None:
     """
     Charge des données binaires (bits) directement depuis la mémoire vers un bucket S3.
  
-    :param file_content: Les données binaires à charger (bytes).
+    :param file_content: Les données binaires à charger (bytes), ou un fichier binaire déjà ouvert.
     :param file_name: Nom du fichier dans S3.
     :param content_type: Type de contenu (MIME type) de l'objet. Ex: 'text/plain', 'image/jpeg'.
                          Si non spécifié, S3 peut essayer de le deviner.
     """
     s3 = boto3.client('s3')
-    file_obj = io.BytesIO(file_content)
+    file_obj = io.BytesIO(file_content) if isinstance(file_content, bytes) else file_content
     #new_name = os.path.splitext(os.path.basename(file_name))[0] + "-" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S_") + os.path.splitext(os.path.basename(file_name))[-1]
     object_name = generate_s3_object_name(file_name, content_type)
 
@@ -1,3 +1,4 @@
+from dataclasses import dataclass
 from langchain_google_genai import ChatGoogleGenerativeAI
 from dotenv import load_dotenv
 
@@ -19,4 +20,17 @@ llm_pro = ChatGoogleGenerativeAI(
     max_tokens=2000,
     timeout=None,
     max_retries=2,
-)
\ No newline at end of file
+)
+
+### CONTEXT BUDGETS ###
+@dataclass(frozen=True)
+class ContextBudget:
+    max_tokens: int                     # tokens allowed in the history sent to the model
+    tool_output_max_tokens: int = 1500  # cap for old tool outputs (web search, code results...)
+    keep_recent: int = 4                # last messages always sent untouched
+    summary_max_tokens: int = 800       # cap for the running summary of dropped messages
+
+CONTEXT_BUDGETS = {
+    llm.model: ContextBudget(max_tokens=48_000),
+    llm_pro.model: ContextBudget(max_tokens=24_000, tool_output_max_tokens=2500),
+}
@@ -1,13 +1,18 @@
+import asyncio
 from typing import Annotated
 from typing_extensions import TypedDict
 from pydantic import BaseModel, Field
-from langchain.schema import SystemMessage
+from langchain.schema import SystemMessage, HumanMessage
+from langchain_core.messages import get_buffer_string
+from langchain_core.runnables import RunnableConfig
 from langgraph.graph import StateGraph, START
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode, tools_condition
 from langgraph.checkpoint.memory import InMemorySaver
 
-from rag.config import llm, llm_pro
+from rag.config import llm, llm_pro, CONTEXT_BUDGETS, ContextBudget
+from rag.compaction import compact_messages, summary_message, truncate_text, COMPACTION_TAG
+from rag.speculation import prefetcher, astream_with_prefetch, with_prefetch_cleanup
 from rag.tools.code_sandbox import code_interpreter
 from rag.tools.files_generation import generate_image
 from rag.tools.satellites import get_satellite_position, get_tle
@@ -27,7 +32,8 @@ checkpointer = InMemorySaver()
 
 
 ## TOOLS
-tools = [TavilySearch(name="web_search", max_results=7), get_satellite_position, get_tle, code_interpreter, generate_image]
+# Deterministic tools are registered on the prefetcher: they start while the model is still streaming
+tools = [prefetcher.register(TavilySearch(name="web_search", max_results=7)), get_satellite_position, prefetcher.register(get_tle), code_interpreter, generate_image]
 tools_expert = [TavilySearch(name="web_search", max_results=16), code_interpreter]
 
 ## Prompts
@@ -37,6 +43,7 @@ system_prompt_content = open("src/docs/GEMINI_SYSTEM_PROMPT.md").read()
 class State(TypedDict):
     messages: Annotated[list, add_messages]
     reasoning_tasks: Annotated[list[str], Field(default_factory=list)]
+    summary: str
 
 class Classification(BaseModel):
     sentiment: str = Field(description="The sentiment of the text")
@@ -47,16 +54,39 @@ graph_builder = StateGraph(State)
 llm_with_tools = llm.bind_tools(tools)
 llmpro_with_tools = llm_pro.bind_tools(tools_expert)
 
+## History compaction
+summarizer = llm.with_config(tags=[COMPACTION_TAG])
 
+def summarize_history(summary: str, messages: list) -> str:
+    transcript = truncate_text(get_buffer_string(messages), 8000)
+    prompt = (
+        "Update the running summary of this conversation with the new messages below. "
+        "Keep the user's goals, the facts and numbers found by the tools, and the decisions taken. "
+        "Answer with the summary only.\n\n"
+        f"Current summary:\n{summary or '(empty)'}\n\nNew messages:\n{transcript}"
+    )
+    return summarizer.invoke([HumanMessage(content=prompt)]).content
 
-def chatbot(state: State):
-    system = [SystemMessage(content=system_prompt_content)]
-    #print("system:", system, flush=True)
-    return {"messages": [llm_with_tools.invoke(system + state["messages"])]}
+def compact_context(state: State, system_content: str, model_name: str):
+    """Returns the messages to send to the model and the state update for the compacted history."""
+    budget = CONTEXT_BUDGETS.get(model_name, ContextBudget(max_tokens=32_000))
+    compacted = compact_messages(state["messages"], state.get("summary", ""), budget, summarize_history)
+    history = ([summary_message(compacted.summary)] if compacted.summary else []) + compacted.messages
+
+    update = {"messages": compacted.removed, "summary": compacted.summary}
+    return [SystemMessage(content=system_content)] + history, update
+
+
+
+async def chatbot(state: State, config: RunnableConfig):
+    messages, update = await asyncio.to_thread(compact_context, state, system_prompt_content, llm.model)
+    update["messages"] = update["messages"] + [await astream_with_prefetch(llm_with_tools, messages, config)]
+    return update
 
 def reasoning_agent(state: State):
-    system = [SystemMessage(content="You are a reasoning agent. You must think step by step to find the best answer.")]
-    return {"messages": [llmpro_with_tools.invoke(system + state["messages"])]}
+    messages, update = compact_context(state, "You are a reasoning agent. You must think step by step to find the best answer.", llm_pro.model)
+    update["messages"] = update["messages"] + [llmpro_with_tools.invoke(messages)]
+    return update
 
 
 
@@ -64,7 +94,7 @@ graph_builder.add_node("generation_task", chatbot)
 graph_builder.add_node("reasoning_task", reasoning_agent)
 tool_node = ToolNode(tools=tools)
 # tool_exp_node = ToolNode(tools=tools_expert)
-graph_builder.add_node("tools", tool_node)
+graph_builder.add_node("tools", with_prefetch_cleanup(tool_node))
 # graph_builder.add_node("tools_expert", tool_exp_node)
 
 ## Graph structure
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import time
+from dataclasses import dataclass, field
+
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.messages.utils import message_chunk_to_message
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.tools import BaseTool, StructuredTool
+
+
+@dataclass
+class PrefetchStats:
+    started: int = 0
+    hits: int = 0
+    wasted: int = 0
+    seconds_saved: float = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "started": self.started,
+            "hits": self.hits,
+            "wasted": self.wasted,
+            "hit_rate": round(self.hits / self.started, 3) if self.started else 0.0,
+            "waste_rate": round(self.wasted / self.started, 3) if self.started else 0.0,
+            "seconds_saved": round(self.seconds_saved, 3),
+        }
+
+PREFETCH_STATS = PrefetchStats()
+
+
+@dataclass
+class _Prefetch:
+    task: asyncio.Task
+    started_at: float = field(default_factory=time.monotonic)
+    done_at: float | None = None
+
+
+def _run_detached(tool: BaseTool, args: dict):
+    # Empty callbacks: the run is not reported in the event stream, only the ToolNode run is
+    return tool.ainvoke(args, config={"callbacks": []})
+
+
+def _call_key(tool: BaseTool, args: dict) -> str | None:
+    """Normalizes the arguments the way the tool will parse them, so that `25544.0` and `25544` match."""
+    try:
+        parsed = tool.get_input_schema().model_validate(args)
+    except Exception:
+        return None
+    normalized = {name: getattr(parsed, name) for name in args if hasattr(parsed, name)}
+    return f"{tool.name}({json.dumps(normalized, sort_keys=True, default=str)})"
+
+
+class ToolPrefetcher:
+    """
+    Runs deterministic tools as soon as the model has streamed their arguments,
+    before `tools_condition` routes to the ToolNode. Results are kept per thread
+    and handed to the ToolNode when the final message asks for the same call.
+    """
+
+    def __init__(self):
+        self.tools: dict[str, BaseTool] = {}
+        self.pending: dict[str, dict[str, list[_Prefetch]]] = {}
+
+    def register(self, tool: BaseTool) -> BaseTool:
+        """Wraps `tool` so that its ToolNode run reuses a prefetched result when there is one."""
+        self.tools[tool.name] = tool
+
+        async def run(config: RunnableConfig, **kwargs):
+            thread_id = config.get("configurable", {}).get("thread_id")
+            prefetch = self._pop(thread_id, _call_key(tool, kwargs))
+            if prefetch is None:
+                return await _run_detached(tool, kwargs)
+
+            PREFETCH_STATS.hits += 1
+            PREFETCH_STATS.seconds_saved += (prefetch.done_at or time.monotonic()) - prefetch.started_at
+            return await prefetch.task
+
+        return StructuredTool.from_function(
+            coroutine=run,
+            name=tool.name,
+            description=tool.description,
+            args_schema=tool.args_schema,
+        )
+
+    def start(self, thread_id: str, name: str, args: dict) -> bool:
+        tool = self.tools.get(name)
+        key = _call_key(tool, args) if tool else None
+        if key is None:
+            return False
+
+        prefetch = _Prefetch(task=asyncio.create_task(_run_detached(tool, args)))
+
+        def on_done(task: asyncio.Task):
+            prefetch.done_at = time.monotonic()
+            # Retrieve the exception so a discarded failing call is not reported as "never retrieved"
+            if not task.cancelled():
+                task.exception()
+
+        prefetch.task.add_done_callback(on_done)
+        self.pending.setdefault(thread_id, {}).setdefault(key, []).append(prefetch)
+        PREFETCH_STATS.started += 1
+        return True
+
+    def settle(self, thread_id: str, message: AIMessage):
+        """Cancels the prefetched calls that the final message does not ask for."""
+        expected = {}
+        for call in message.tool_calls:
+            tool = self.tools.get(call["name"])
+            key = _call_key(tool, call["args"]) if tool else None
+            if key is not None:
+                expected[key] = expected.get(key, 0) + 1
+
+        kept = {}
+        for key, prefetches in self.pending.pop(thread_id, {}).items():
+            self._cancel(prefetches[expected.get(key, 0):])
+            if prefetches[:expected.get(key, 0)]:
+                kept[key] = prefetches[:expected.get(key, 0)]
+        if kept:
+            self.pending[thread_id] = kept
+
+    def discard(self, thread_id: str):
+        """Cancels everything left for a thread, e.g. when the request ends."""
+        for prefetches in self.pending.pop(thread_id, {}).values():
+            self._cancel(prefetches)
+
+    def _pop(self, thread_id: str | None, key: str | None) -> _Prefetch | None:
+        prefetches = self.pending.get(thread_id, {}).get(key)
+        if not prefetches:
+            return None
+        return prefetches.pop(0)
+
+    def _cancel(self, prefetches: list[_Prefetch]):
+        for prefetch in prefetches:
+            prefetch.task.cancel()
+            PREFETCH_STATS.wasted += 1
+        if prefetches:
+            print(f"Tool prefetch: {len(prefetches)} result(s) discarded | total: {PREFETCH_STATS.as_dict()}", flush=True)
+
+prefetcher = ToolPrefetcher()
+
+
+def with_prefetch_cleanup(tool_node: Runnable):
+    """Graph node running `tool_node`, then discarding the prefetched results it did not use."""
+    async def run_tools(state: dict, config: RunnableConfig):
+        try:
+            return await tool_node.ainvoke(state, config)
+        finally:
+            prefetcher.discard(config.get("configurable", {}).get("thread_id"))
+
+    return run_tools
+
+
+def _complete_args(args: str | None) -> dict | None:
+    # A JSON object only parses once its closing brace has been streamed
+    try:
+        parsed = json.loads(args or "")
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+async def astream_with_prefetch(model: Runnable, messages: list[BaseMessage], config: RunnableConfig) -> AIMessage:
+    """
+    Streams `model` and starts the prefetchable tool calls as soon as their arguments are complete.
+    Returns the final message, like `model.invoke(messages)` would.
+    """
+    thread_id = config.get("configurable", {}).get("thread_id")
+    aggregate = None
+    started = set()
+
+    async for chunk in model.astream(messages):
+        aggregate = chunk if aggregate is None else aggregate + chunk
+        for position, call in enumerate(aggregate.tool_call_chunks):
+            key = call.get("index") if call.get("index") is not None else position
+            if key in started or not call.get("name"):
+                continue
+            args = _complete_args(call.get("args"))
+            if args is not None:
+                started.add(key)
+                prefetcher.start(thread_id, call["name"], args)
+
+    if aggregate is None:
+        # Nothing was streamed (no chunk at all): no call was prefetched, ask again without streaming
+        prefetcher.discard(thread_id)
+        return await model.ainvoke(messages)
+
+    message = message_chunk_to_message(aggregate)
+    prefetcher.settle(thread_id, message)
+    return message
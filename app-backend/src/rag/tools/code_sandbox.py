@@ -1,88 +1,205 @@
 from langchain_core.tools import tool
+from queue import Empty
+from uuid import uuid4
+import os
+import shutil
+import tempfile
+import time
 import jupyter_client
+import zmq
+
+from config.config import CONFIG
+from rag.tools.sandbox_limits import (
+    TRUNCATION_MIME_TYPE,
+    apply_kernel_limits,
+    kernel_setup_code,
+    max_message_bytes,
+    new_output_buffer,
+    offload_image,
+)
+
+
+def _client_context() -> zmq.Context:
+    """
+    ZMQ context whose sockets refuse oversized kernel messages and queue only a few of them:
+    at most `SANDBOX_RECEIVE_HWM` messages of `max_message_bytes()` wait while an image is uploaded.
+    """
+    context = zmq.Context()
+    context.setsockopt(zmq.MAXMSGSIZE, max_message_bytes())
+    context.setsockopt(zmq.RCVHWM, CONFIG.SANDBOX_RECEIVE_HWM)
+    return context
+
+
+def _get_shell_reply(client, msg_id: str, timeout: float) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        reply = client.get_shell_msg(timeout=max(deadline - time.monotonic(), 0))
+        if reply['parent_header'].get('msg_id') == msg_id:
+            return reply
+
+
+def _recover_kernel_spill(output, spill_path: str):
+    """
+    When the execution is interrupted (timeout, dead kernel), the kernel never reports what its
+    capped stream dropped: the size of its spill file tells, and the file holds the full output.
+    """
+    if output.spill_path is None and os.path.exists(spill_path):
+        output.skip(max(os.path.getsize(spill_path) - output.total_chars, 0), spill_path)
+
 
 @tool
 def code_interpreter(code: str, timeout: int = 60) -> dict:
     """
     Executes Python code in a new isolated Jupyter kernel (a local sandbox).
     Python version used: 3.10.
+    The kernel is limited in memory and CPU time, long outputs are truncated
+    (beginning and end are kept) and images are stored on S3.
 
     Args:
         code: The Python code string to execute.
-        timeout: The maximum time in seconds to wait for execution to finish.
+        timeout: The maximum time in seconds to wait for execution to finish (at most 120).
 
     Returns:
         A dictionary containing 'stdout' (standard output), 'stderr' (errors),
-        and 'result' (the result of the last expression, if any).
+        'result' (the result of the last expression, if any) and 'files'
+        (S3 references of the images and of the full outputs when truncated).
     """
+    timeout = max(1, min(timeout, CONFIG.SANDBOX_MAX_WALL_SECONDS))
     km = jupyter_client.KernelManager()
+    context = _client_context()
+    spill_dir = tempfile.mkdtemp(prefix="sandbox-")
+    execution_id = uuid4().hex[:12]
+    stdout_output = new_output_buffer()
+    stderr_output = new_output_buffer()
+    execution_result = None
+    files = []
+    images = 0
+    skipped_images = 0
+    interrupted = False
     try:
-        km.start_kernel()
+        km.start_kernel(preexec_fn=apply_kernel_limits)
 
-        client = km.client()
+        client = km.client(context=context)
         client.start_channels()
         client.wait_for_ready(timeout=timeout)
 
-        stdout_output = []
-        stderr_output = []
-        execution_result = None
-
         try:
+            setup_id = client.execute(kernel_setup_code(spill_dir), silent=True, store_history=False)
+            setup_reply = _get_shell_reply(client, setup_id, timeout)
+            if setup_reply['content']['status'] != 'ok':
+                raise RuntimeError(
+                    f"unable to set up the sandbox outputs ({setup_reply['content'].get('ename')}: "
+                    f"{setup_reply['content'].get('evalue')}), the code was not executed"
+                )
+
             msg_id = client.execute(code)
-            reply = client.get_shell_msg(timeout=timeout)
-
-            if reply and reply['msg_type'] == 'execute_reply':
-                status = reply['content']['status']
-
-                if status == 'ok':
-                    # Collect all outputs (stdout, stderr, results, etc.)
-                    while True:
-                        try:
-                            msg = client.get_iopub_msg(timeout=1)
-                            msg_type = msg['msg_type']
-                            content = msg['content']
-
-                            if msg_type == 'stream':
-                                if content['name'] == 'stdout':
-                                    stdout_output.append(content['text'])
-                                elif content['name'] == 'stderr':
-                                    stderr_output.append(content['text'])
-                            elif msg_type == 'display_data' or msg_type == 'execute_result':
-                                # For simplicity, we take the textual representation
-                                if 'data' in content and 'text/plain' in content['data']:
-                                    execution_result = content['data']['text/plain']
-                            elif msg_type == 'status' and content['execution_state'] == 'idle':
-                                # The kernel is idle, execution is probably finished
-                                break
-                        except TimeoutError:
-                            # No more messages for now, exit if we've already processed the main reply
-                            break
-                elif status == 'error':
-                    stderr_output.append(f"Error type: {reply['content'].get('ename')}\n")
-                    stderr_output.append(f"Error value: {reply['content'].get('evalue')}\n")
-                    stderr_output.extend(reply['content'].get('traceback', []))
-            else:
-                stderr_output.append(f"No valid execution reply received or timeout. Reply: {reply}")
-
-        except TimeoutError:
-            stderr_output.append(f"Code execution exceeded the timeout of {timeout} seconds.")
+            deadline = time.monotonic() + timeout
+            replied = False
+
+            # Outputs are read while the code runs, so they never pile up in the client queues
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    stderr_output.write(f"Code execution exceeded the timeout of {timeout} seconds.")
+                    interrupted = True
+                    break
+                try:
+                    msg = client.get_iopub_msg(timeout=min(remaining, 1))
+                except Empty:
+                    if replied:
+                        # The idle status was lost with other outputs (refused or dropped messages)
+                        stderr_output.write(
+                            f"Some outputs were dropped: messages are limited to {max_message_bytes() // (1024 * 1024)} MB."
+                        )
+                        break
+                    if not km.is_alive():
+                        stderr_output.write(
+                            f"The kernel died during execution (limits: {CONFIG.SANDBOX_MAX_MEMORY_MB} MB, "
+                            f"{CONFIG.SANDBOX_MAX_CPU_SECONDS} s of CPU)."
+                        )
+                        interrupted = True
+                        break
+                    if client.shell_channel.msg_ready():
+                        replied = client.get_shell_msg(timeout=0)['parent_header'].get('msg_id') == msg_id
+                    continue
+
+                if msg['parent_header'].get('msg_id') != msg_id:
+                    continue
+                msg_type = msg['msg_type']
+                content = msg['content']
+
+                if msg_type == 'stream':
+                    if content['name'] == 'stdout':
+                        stdout_output.write(content['text'])
+                    elif content['name'] == 'stderr':
+                        stderr_output.write(content['text'])
+                elif msg_type == 'display_data' or msg_type == 'execute_result':
+                    data = content.get('data', {})
+                    if TRUNCATION_MIME_TYPE in data:
+                        # The kernel dropped the middle of a stream, the full output is in the spill file
+                        notice = data[TRUNCATION_MIME_TYPE]
+                        output = stdout_output if notice['name'] == 'stdout' else stderr_output
+                        output.skip(notice['dropped'], notice['path'])
+                        continue
+                    for mime_type in ('image/png', 'image/jpeg', 'image/svg+xml'):
+                        if mime_type not in data:
+                            continue
+                        if images < CONFIG.SANDBOX_MAX_IMAGES:
+                            files.append(offload_image(data[mime_type], mime_type, f"sandbox_{execution_id}_image{images}"))
+                            images += 1
+                        else:
+                            skipped_images += 1
+                    # For simplicity, we take the textual representation
+                    if 'text/plain' in data:
+                        if execution_result is not None:
+                            execution_result.close()
+                        execution_result = new_output_buffer()
+                        execution_result.write(data['text/plain'])
+                elif msg_type == 'error':
+                    stderr_output.write(f"Error type: {content.get('ename')}\n")
+                    stderr_output.write(f"Error value: {content.get('evalue')}\n")
+                    for line in content.get('traceback', []):
+                        stderr_output.write(line)
+                elif msg_type == 'status' and content['execution_state'] == 'idle':
+                    # The kernel is idle, execution is finished
+                    break
+
         except Exception as e:
-            stderr_output.append(f"An unexpected error occurred while interacting with the kernel: {e}")
+            stderr_output.write(f"An unexpected error occurred while interacting with the kernel: {e}")
+            interrupted = True
         finally:
             print("Stopping client channels.")
             client.stop_channels()
 
     except Exception as e:
-        stderr_output.append(f"Unable to start or interact with the Jupyter kernel: {e}")
+        stderr_output.write(f"Unable to start or interact with the Jupyter kernel: {e}")
     finally:
         if km.is_alive():
             print("Shutting down Jupyter kernel.")
             km.shutdown_kernel(now=True)
         else:
             print("The Jupyter kernel was not active or has already been stopped.")
+        context.destroy(linger=0)
+
+    if interrupted:
+        _recover_kernel_spill(stdout_output, os.path.join(spill_dir, "stdout.txt"))
+        _recover_kernel_spill(stderr_output, os.path.join(spill_dir, "stderr.txt"))
+    if skipped_images:
+        files.append(f"[{skipped_images} images ignored: only the first {CONFIG.SANDBOX_MAX_IMAGES} are kept]")
+    outputs = (("stdout", stdout_output), ("stderr", stderr_output), ("result", execution_result))
+    for name, output in outputs:
+        reference = output.offload(f"sandbox_{execution_id}_{name}.txt") if output is not None else None
+        if reference:
+            files.append(reference)
 
-    return {
-        "stdout": "".join(stdout_output).strip(),
-        "stderr": "".join(stderr_output).strip(),
-        "result": execution_result.strip() if execution_result else None
-    }
\ No newline at end of file
+    result = {
+        "stdout": stdout_output.getvalue().strip(),
+        "stderr": stderr_output.getvalue().strip(),
+        "result": execution_result.getvalue().strip() if execution_result else None,
+        "files": files,
+    }
+    for _, output in outputs:
+        if output is not None:
+            output.close()
+    shutil.rmtree(spill_dir, ignore_errors=True)
+    return result
@@ -0,0 +1,250 @@
+import base64
+import ctypes
+import os
+import resource
+import tempfile
+from collections import deque
+
+from config.config import CONFIG
+from models.s3.upload_files import upload_files_to_s3
+
+
+# Mime type of the notice sent by the kernel when it dropped the middle of a stream
+TRUNCATION_MIME_TYPE = "application/vnd.sandbox.truncation+json"
+
+# prctl(2) option and capability number, from <linux/prctl.h> and <linux/capability.h>
+_PR_CAPBSET_DROP = 24
+_CAP_SYS_RESOURCE = 24
+# Resolved before any fork: only a plain C call is made in the child
+_prctl = getattr(ctypes.CDLL(None), "prctl", None)
+
+
+def apply_kernel_limits():
+    """
+    `preexec_fn` of the kernel process, run between fork and exec: the limits are set
+    before any user code runs. CAP_SYS_RESOURCE is dropped from the capability bounding
+    set, so a kernel started as root cannot raise its hard limits again.
+    """
+    memory = CONFIG.SANDBOX_MAX_MEMORY_MB * 1024 * 1024
+    file_size = CONFIG.SANDBOX_MAX_FILE_SIZE_MB * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_DATA, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (file_size, file_size))
+    resource.setrlimit(resource.RLIMIT_CPU, (CONFIG.SANDBOX_MAX_CPU_SECONDS, CONFIG.SANDBOX_MAX_CPU_SECONDS + 5))
+    if _prctl is not None:
+        # Fails without CAP_SETPCAP, i.e. when not root: the hard limits cannot be raised anyway
+        _prctl(_PR_CAPBSET_DROP, _CAP_SYS_RESOURCE, 0, 0, 0)
+
+
+def max_message_bytes() -> int:
+    """Largest kernel message accepted: a base64 image of `SANDBOX_MAX_IMAGE_MB`, plus 1 MB of headers and text."""
+    return CONFIG.SANDBOX_MAX_IMAGE_MB * 1024 * 1024 * 4 // 3 + 1024 * 1024
+
+
+# Run silently in the kernel before the user code: stdout/stderr are capped at the source so that
+# large outputs are not sent to the API process. User code can undo it: this only saves messages,
+# the API side bounds its memory on its own (`OutputBuffer`, socket limits).
+_KERNEL_SETUP_CODE = '''
+import collections as _collections, os as _os, sys as _sys
+
+
+class _CappedStream:
+    """Forwards the first characters written, keeps the last ones and spills everything to a capped file."""
+
+    def __init__(self, stream, name):
+        self._stream = stream
+        self._name = name
+        self._spill_path = _os.path.join({spill_dir!r}, name + ".txt")
+        self._spill = None
+        self._spilled = 0
+        self._head_left = {head}
+        self._tail = _collections.deque()
+        self._tail_len = 0
+        self._dropped = 0
+
+    def write(self, text):
+        text = str(text)
+        self._write_spill(text)
+        written = len(text)
+        if self._head_left > 0:
+            self._stream.write(text[:self._head_left])
+            text = text[self._head_left:]
+            self._head_left -= written - len(text)
+        if text:
+            self._tail.append(text)
+            self._tail_len += len(text)
+            while self._tail_len > {tail}:
+                excess = self._tail_len - {tail}
+                if len(self._tail[0]) <= excess:
+                    removed = len(self._tail.popleft())
+                else:
+                    removed = excess
+                    self._tail[0] = self._tail[0][excess:]
+                self._tail_len -= removed
+                self._dropped += removed
+        return written
+
+    def _write_spill(self, text):
+        if self._spilled >= {spill_max}:
+            return
+        if self._spill is None:
+            self._spill = open(self._spill_path, "wb")
+        data = text.encode("utf-8", errors="replace")[:{spill_max} - self._spilled]
+        self._spill.write(data)
+        self._spilled += len(data)
+
+    def finish(self):
+        if self._spill is not None:
+            self._spill.close()
+        if self._dropped:
+            from IPython.display import publish_display_data
+            self._stream.flush()
+            publish_display_data({{{mime!r}: {{"name": self._name, "dropped": self._dropped, "path": self._spill_path}}}})
+        if self._tail:
+            self._stream.write("".join(self._tail))
+        self._stream.flush()
+
+    def flush(self):
+        self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+_sys.stdout = _CappedStream(_sys.stdout, "stdout")
+_sys.stderr = _CappedStream(_sys.stderr, "stderr")
+get_ipython().events.register("post_run_cell", lambda _: (_sys.stdout.finish(), _sys.stderr.finish()))
+if hasattr(get_ipython(), "_tee"):
+    # IPython >= 9 keeps a copy of every write in its output history, the kernel would hold the whole output
+    import contextlib as _contextlib
+    get_ipython()._tee = lambda channel: _contextlib.nullcontext()
+del _collections
+'''
+
+
+def kernel_setup_code(spill_dir: str) -> str:
+    """Code run silently in the kernel before the user code, `spill_dir` receives the full outputs."""
+    return _KERNEL_SETUP_CODE.format(
+        spill_dir=spill_dir,
+        head=CONFIG.SANDBOX_OUTPUT_HEAD_CHARS,
+        tail=CONFIG.SANDBOX_OUTPUT_TAIL_CHARS,
+        spill_max=CONFIG.SANDBOX_SPILL_MAX_MB * 1024 * 1024,
+        mime=TRUNCATION_MIME_TYPE,
+    )
+
+
+def s3_reference(object_name: str) -> str:
+    return f"s3://{CONFIG.S3_BUCKET_NAME}/generated/{object_name}"
+
+
+class OutputBuffer:
+    """
+    Bounded output collector: keeps the first `head_chars` and the last
+    `tail_chars` characters in memory. The full output is copied to a spooled
+    temporary file (on disk past 1 MB, capped at `spill_max_bytes`) so it can be
+    offloaded to S3 when it is truncated. Characters already dropped by the
+    kernel are reported with `skip()`, along with the file holding them.
+    """
+
+    def __init__(self, head_chars: int, tail_chars: int, spill_max_bytes: int = 0):
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.spill_max_bytes = spill_max_bytes
+        self.head = []
+        self.head_len = 0
+        self.tail = deque()
+        self.tail_len = 0
+        self.total_chars = 0
+        self.spill = tempfile.SpooledTemporaryFile(max_size=1024 * 1024) if spill_max_bytes else None
+        self.spilled_bytes = 0
+        self.spill_path = None
+
+    def write(self, text: str):
+        self.total_chars += len(text)
+        self._write_spill(text)
+
+        if self.head_len < self.head_chars:
+            kept = text[:self.head_chars - self.head_len]
+            self.head.append(kept)
+            self.head_len += len(kept)
+            text = text[len(kept):]
+        if not text:
+            return
+
+        self.tail.append(text)
+        self.tail_len += len(text)
+        while self.tail_len > self.tail_chars:
+            excess = self.tail_len - self.tail_chars
+            if len(self.tail[0]) <= excess:
+                self.tail_len -= len(self.tail.popleft())
+            else:
+                self.tail[0] = self.tail[0][excess:]
+                self.tail_len -= excess
+
+    def skip(self, dropped_chars: int, spill_path: str | None = None):
+        """Records characters dropped before reaching this buffer; `spill_path` holds the full output."""
+        self.total_chars += dropped_chars
+        if spill_path:
+            self.spill_path = spill_path
+
+    def _write_spill(self, text: str):
+        if self.spill is None or self.spilled_bytes >= self.spill_max_bytes:
+            return
+        data = text.encode("utf-8", errors="replace")[:self.spill_max_bytes - self.spilled_bytes]
+        self.spill.write(data)
+        self.spilled_bytes += len(data)
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_chars > self.head_len + self.tail_len
+
+    def getvalue(self) -> str:
+        head = "".join(self.head)
+        tail = "".join(self.tail)
+        if not self.truncated:
+            return head + tail
+        dropped = self.total_chars - self.head_len - self.tail_len
+        return f"{head}\n...[{dropped} characters truncated]...\n{tail}"
+
+    def offload(self, file_name: str) -> str | None:
+        """Uploads the full output to S3 when the in-memory copy was truncated."""
+        if not self.truncated:
+            return None
+
+        if self.spill_path and os.path.exists(self.spill_path):
+            with open(self.spill_path, "rb") as spill:
+                object_name = upload_files_to_s3(spill, file_name, "text/plain", role="generation")
+        elif self.spill is not None:
+            self.spill.seek(0)
+            object_name = upload_files_to_s3(self.spill, file_name, "text/plain", role="generation")
+        else:
+            return None
+        return s3_reference(object_name) if object_name else None
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+
+def new_output_buffer() -> OutputBuffer:
+    return OutputBuffer(
+        head_chars=CONFIG.SANDBOX_OUTPUT_HEAD_CHARS,
+        tail_chars=CONFIG.SANDBOX_OUTPUT_TAIL_CHARS,
+        spill_max_bytes=CONFIG.SANDBOX_SPILL_MAX_MB * 1024 * 1024,
+    )
+
+
+def offload_image(data: str, mime_type: str, file_stem: str) -> str:
+    """
+    Uploads an image displayed by the code to S3 and returns a reference instead of the payload.
+    `file_stem` must be unique per image: S3 names only add a timestamp to the second.
+    """
+    # Jupyter sends SVG as text, the other image types as base64
+    content = data.encode("utf-8") if mime_type == "image/svg+xml" else None
+    size = len(content) if content is not None else len(data) * 3 // 4
+    if size > CONFIG.SANDBOX_MAX_IMAGE_MB * 1024 * 1024:
+        return f"[{mime_type} image dropped: larger than {CONFIG.SANDBOX_MAX_IMAGE_MB} MB]"
+    extension = mime_type.split("/")[-1].split("+")[0]
+    if content is None:
+        content = base64.b64decode(data)
+    object_name = upload_files_to_s3(content, f"{file_stem}.{extension}", mime_type, role="generation")
+    return s3_reference(object_name) if object_name else f"[{mime_type} image could not be stored]"
@@ -0,0 +1,4 @@
+import os
+
+# rag.config builds the Gemini clients on import; the unit tests never call them
+os.environ.setdefault("GOOGLE_API_KEY", "unit-tests")
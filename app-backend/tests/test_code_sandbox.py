@@ -0,0 +1,130 @@
+import resource
+
+import pytest
+
+from config.config import CONFIG
+
+from rag.tools import sandbox_limits
+from rag.tools.code_sandbox import code_interpreter
+
+# Peak RSS growth allowed in the API process while the kernel floods it
+MAX_RSS_GROWTH_MB = 50
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+REFERENCE_PREFIX = f"s3://{CONFIG.S3_BUCKET_NAME}/generated/"
+
+
+@pytest.fixture(autouse=True)
+def no_s3(monkeypatch):
+    # Returns the requested name as object name, so that colliding names show up
+    monkeypatch.setattr(sandbox_limits, "upload_files_to_s3", lambda file_content, file_name, *args, **kwargs: file_name)
+
+
+@pytest.fixture(scope="module", autouse=True)
+def warm_up():
+    # Loads the kernel machinery once, so that its own allocations are not measured
+    code_interpreter.invoke({"code": "1 + 1"})
+
+
+def test_simple_execution():
+    result = code_interpreter.invoke({"code": "print('hello')\n21 * 2"})
+
+    assert result == {"stdout": "hello", "stderr": "", "result": "42", "files": []}
+
+
+def test_print_flood_keeps_api_memory_flat():
+    before = peak_rss_mb()
+    result = code_interpreter.invoke({"code": "for _ in range(200):\n    print('x' * 10**7)", "timeout": 60})
+
+    assert peak_rss_mb() - before < MAX_RSS_GROWTH_MB
+    assert "characters truncated" in result["stdout"]
+    assert len(result["stdout"]) < 10_000
+    assert len(result["files"]) == 1
+    assert result["files"][0].startswith(REFERENCE_PREFIX) and result["files"][0].endswith("_stdout.txt")
+
+
+def test_endless_print_flood_stops_at_timeout():
+    before = peak_rss_mb()
+    result = code_interpreter.invoke({"code": "while True:\n    print('x' * 10**7)", "timeout": 5})
+
+    assert peak_rss_mb() - before < MAX_RSS_GROWTH_MB
+    assert "exceeded the timeout of 5 seconds" in result["stderr"]
+    # The kernel never reported the end of its output: it is recovered from the spill file
+    assert "characters truncated" in result["stdout"]
+    assert len(result["stdout"]) < 10_000
+    assert len(result["files"]) == 1 and result["files"][0].endswith("_stdout.txt")
+
+
+def test_each_image_gets_its_own_reference():
+    code = (
+        "from IPython.display import Image, display\n"
+        "display(Image(data=b'first', format='png'))\n"
+        "display(Image(data=b'second', format='png'))\n"
+    )
+    first = code_interpreter.invoke({"code": code})["files"]
+    second = code_interpreter.invoke({"code": code})["files"]
+
+    assert len(first) == 2
+    assert len(set(first + second)) == 4
+
+
+def test_image_flood_keeps_api_memory_flat():
+    code = (
+        "import os\n"
+        "from IPython.display import Image, display\n"
+        "for _ in range(100):\n"
+        "    display(Image(data=os.urandom(2_000_000), format='png'))\n"
+    )
+    before = peak_rss_mb()
+    result = code_interpreter.invoke({"code": code, "timeout": 60})
+
+    assert peak_rss_mb() - before < MAX_RSS_GROWTH_MB
+    assert len(result["files"]) == 11
+    assert len(set(result["files"])) == 11
+    assert result["files"][-1] == "[90 images ignored: only the first 10 are kept]"
+
+
+def test_oversized_messages_are_refused():
+    code = (
+        "import os\n"
+        "from IPython.display import Image, display\n"
+        "for _ in range(5):\n"
+        "    display(Image(data=os.urandom(20_000_000), format='png'))\n"
+    )
+    before = peak_rss_mb()
+    result = code_interpreter.invoke({"code": code, "timeout": 30})
+
+    assert peak_rss_mb() - before < MAX_RSS_GROWTH_MB
+    assert result["files"] == []
+
+
+def test_code_cannot_raise_its_limits():
+    code = (
+        "import resource\n"
+        "resource.setrlimit(resource.RLIMIT_DATA, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))\n"
+    )
+    result = code_interpreter.invoke({"code": code})
+
+    assert "not allowed to raise maximum limit" in result["stderr"]
+
+
+def test_uncapped_stdout_keeps_api_memory_flat():
+    # The capped stream in the kernel is only an optimisation: the code can put back the original one
+    code = (
+        "import sys\n"
+        "sys.stdout = sys.stdout._stream\n"
+        "for _ in range(100):\n"
+        "    print('x' * 10**7)\n"
+    )
+    before = peak_rss_mb()
+    result = code_interpreter.invoke({"code": code, "timeout": 60})
+
+    # Depending on how the kernel batches the output, it is truncated, refused or the kernel dies on its memory limit
+    assert peak_rss_mb() - before < MAX_RSS_GROWTH_MB
+    assert len(result["stdout"]) < 10_000
+    assert result["stderr"] or "characters truncated" in result["stdout"]
@@ -0,0 +1,162 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+from rag.config import ContextBudget
+from rag.compaction import (
+    CLIENT_HISTORY_PREFIX,
+    MEDIA_BLOCK_TOKENS,
+    _find_cut,
+    _shrink_tool_outputs,
+    _valid_cuts,
+    compact_messages,
+    count_tokens,
+)
+
+
+def tool_step(index: int, output: str, name: str = "web_search", args: dict | None = None):
+    """An AIMessage calling one tool, followed by its result."""
+    call_id = f"call-{index}"
+    return [
+        AIMessage(id=f"ai-{index}", content="", tool_calls=[{"name": name, "args": args if args is not None else {"query": str(index)}, "id": call_id}]),
+        ToolMessage(id=f"tool-{index}", content=output, tool_call_id=call_id),
+    ]
+
+
+def agent_turn(steps: int, output_size: int = 20_000) -> list:
+    messages = [HumanMessage(id="question", content="question")]
+    for index in range(steps):
+        messages += tool_step(index, "x" * output_size)
+    return messages
+
+
+class Summarizer:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = []
+
+    def __call__(self, summary, messages):
+        self.calls.append([message.id for message in messages])
+        if self.fail:
+            raise RuntimeError("LLM unavailable")
+        return f"summary of {len(messages)} messages"
+
+
+def test_media_blocks_have_a_fixed_cost():
+    image = HumanMessage(content=[
+        {"type": "text", "text": "hi"},
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64," + "A" * 200_000}},
+    ])
+
+    assert MEDIA_BLOCK_TOKENS <= count_tokens([image]) < MEDIA_BLOCK_TOKENS + 20
+
+
+def test_valid_cuts_never_separate_a_tool_call_from_its_result():
+    messages = agent_turn(2)
+
+    # 0: question, 1: ai-0, 2: tool-0, 3: ai-1, 4: tool-1
+    assert _valid_cuts(messages) == [1, 3]
+
+
+def test_valid_cuts_with_parallel_tool_calls():
+    messages = [
+        HumanMessage(content="question"),
+        AIMessage(content="", tool_calls=[
+            {"name": "web_search", "args": {"query": "a"}, "id": "a"},
+            {"name": "web_search", "args": {"query": "b"}, "id": "b"},
+        ]),
+        ToolMessage(content="a", tool_call_id="a"),
+        ToolMessage(content="b", tool_call_id="b"),
+        AIMessage(content="answer"),
+    ]
+
+    assert _valid_cuts(messages) == [1, 4]
+
+
+def test_find_cut_keeps_the_question_of_the_current_turn():
+    messages = agent_turn(4, output_size=4000)
+
+    cut, anchor = _find_cut(messages, max_tokens=1500)
+
+    assert messages[cut].id == "ai-3"
+    assert anchor == 0
+
+
+def test_find_cut_on_a_human_message_has_no_anchor():
+    messages = [HumanMessage(content="x" * 8000), AIMessage(content="answer"), HumanMessage(content="new question")]
+
+    assert _find_cut(messages, max_tokens=100) == (2, None)
+
+
+def test_repeated_tool_calls_are_superseded():
+    messages = [HumanMessage(content="question")]
+    messages += tool_step(0, "old result", args={"query": "same"})
+    messages += tool_step(1, "other result", args={"query": "other"})
+    messages += tool_step(2, "new result", args={"query": "same"})
+
+    shrunk = _shrink_tool_outputs(messages, ContextBudget(max_tokens=1000, keep_recent=2))
+
+    assert shrunk[2].content == "[Superseded by a later identical tool call]"
+    assert shrunk[4].content == "other result"
+    assert shrunk[6].content == "new result"
+
+
+def test_history_under_budget_is_untouched():
+    messages = agent_turn(1, output_size=100)
+    summarize = Summarizer()
+
+    result = compact_messages(messages, "", ContextBudget(max_tokens=10_000), summarize)
+
+    assert result.messages == messages
+    assert result.removed == []
+    assert summarize.calls == []
+
+
+def test_old_steps_are_summarized_and_removed_from_the_state():
+    messages = agent_turn(6)
+    summarize = Summarizer()
+    budget = ContextBudget(max_tokens=6000, tool_output_max_tokens=500, keep_recent=2, summary_max_tokens=200)
+
+    result = compact_messages(messages, "", budget, summarize)
+
+    assert [message.id for message in result.messages] == ["question", "ai-4", "tool-4", "ai-5", "tool-5"]
+    assert summarize.calls == [["ai-0", "tool-0", "ai-1", "tool-1", "ai-2", "tool-2", "ai-3", "tool-3"]]
+    assert [message.id for message in result.removed] == summarize.calls[0]
+    assert result.summary == "summary of 8 messages"
+    assert result.tokens_after <= budget.max_tokens
+
+
+def test_history_is_kept_when_summarization_fails():
+    messages = agent_turn(6)
+    budget = ContextBudget(max_tokens=6000, tool_output_max_tokens=500, keep_recent=2, summary_max_tokens=200)
+
+    result = compact_messages(messages, "previous summary", budget, Summarizer(fail=True))
+
+    assert [message.id for message in result.messages] == [message.id for message in messages]
+    assert result.removed == []
+    assert result.summary == "previous summary"
+
+
+def test_client_history_is_dropped_without_summary():
+    messages = [
+        HumanMessage(id=CLIENT_HISTORY_PREFIX + "1", content="x" * 40_000),
+        AIMessage(id=CLIENT_HISTORY_PREFIX + "2", content="y" * 40_000),
+        HumanMessage(id="question", content="new question"),
+    ]
+    summarize = Summarizer()
+
+    result = compact_messages(messages, "", ContextBudget(max_tokens=2000), summarize)
+
+    assert summarize.calls == []
+    assert [message.id for message in result.messages] == ["question"]
+    assert [message.id for message in result.removed] == [CLIENT_HISTORY_PREFIX + "1", CLIENT_HISTORY_PREFIX + "2"]
+
+
+@pytest.mark.parametrize("keep_recent", [2, 4])
+def test_recent_tool_outputs_are_truncated_when_over_budget(keep_recent):
+    messages = [HumanMessage(id="question", content="question")] + tool_step(0, "x" * 400_000)
+    budget = ContextBudget(max_tokens=4000, keep_recent=keep_recent, summary_max_tokens=200)
+
+    result = compact_messages(messages, "", budget, Summarizer())
+
+    assert result.tokens_after <= budget.max_tokens
+    assert "characters truncated" in result.messages[-1].content
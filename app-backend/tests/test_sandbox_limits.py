@@ -0,0 +1,94 @@
+import pytest
+
+from rag.tools import sandbox_limits
+from rag.tools.sandbox_limits import OutputBuffer
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    """Replaces the S3 upload, records (file name, content) instead."""
+    uploaded = []
+
+    def fake_upload(file_content, file_name, content_type="text/plain", role="upload"):
+        data = file_content if isinstance(file_content, bytes) else file_content.read()
+        uploaded.append((file_name, data))
+        return f"text/{file_name}"
+
+    monkeypatch.setattr(sandbox_limits, "upload_files_to_s3", fake_upload)
+    return uploaded
+
+
+def test_output_under_budget_is_kept_whole():
+    output = OutputBuffer(head_chars=10, tail_chars=10)
+    output.write("hello ")
+    output.write("world")
+
+    assert not output.truncated
+    assert output.getvalue() == "hello world"
+
+
+def test_output_keeps_head_and_tail():
+    output = OutputBuffer(head_chars=5, tail_chars=5)
+    for index in range(100):
+        output.write(f"{index:03d}\n")
+
+    assert output.truncated
+    assert output.head_len == 5
+    assert output.tail_len == 5
+    assert output.getvalue() == "000\n0\n...[390 characters truncated]...\n\n099\n"
+
+
+def test_output_tail_is_trimmed_inside_a_single_write():
+    output = OutputBuffer(head_chars=2, tail_chars=3)
+    output.write("a" * 2 + "b" * 1000 + "xyz")
+
+    assert output.getvalue() == "aa\n...[1000 characters truncated]...\nxyz"
+
+
+def test_skip_counts_characters_dropped_by_the_kernel():
+    output = OutputBuffer(head_chars=3, tail_chars=3)
+    output.write("abc")
+    output.skip(42, "/tmp/stdout.txt")
+    output.write("xyz")
+
+    assert output.truncated
+    assert output.spill_path == "/tmp/stdout.txt"
+    assert output.getvalue() == "abc\n...[42 characters truncated]...\nxyz"
+
+
+def test_offload_does_nothing_when_not_truncated(uploads):
+    output = OutputBuffer(head_chars=10, tail_chars=10, spill_max_bytes=100)
+    output.write("short")
+
+    assert output.offload("sandbox_stdout.txt") is None
+    assert uploads == []
+
+
+def test_offload_uploads_the_spilled_output(uploads):
+    output = OutputBuffer(head_chars=2, tail_chars=2, spill_max_bytes=8)
+    output.write("0123456789")
+
+    reference = output.offload("sandbox_stdout.txt")
+
+    assert reference == "s3://the-universal-agent/generated/text/sandbox_stdout.txt"
+    assert uploads == [("sandbox_stdout.txt", b"01234567")]
+
+
+def test_offload_prefers_the_kernel_spill_file(uploads, tmp_path):
+    spill = tmp_path / "stdout.txt"
+    spill.write_bytes(b"full kernel output")
+    output = OutputBuffer(head_chars=2, tail_chars=2, spill_max_bytes=100)
+    output.write("fu")
+    output.skip(14, str(spill))
+    output.write("ut")
+
+    output.offload("sandbox_stdout.txt")
+
+    assert uploads == [("sandbox_stdout.txt", b"full kernel output")]
+
+
+def test_images_are_uploaded_under_the_given_name(uploads):
+    reference = sandbox_limits.offload_image("aGVsbG8=", "image/png", "sandbox_1234_image0")
+
+    assert reference == "s3://the-universal-agent/generated/text/sandbox_1234_image0.png"
+    assert uploads == [("sandbox_1234_image0.png", b"hello")]
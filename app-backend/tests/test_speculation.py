@@ -0,0 +1,124 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.tools import StructuredTool
+
+from rag import speculation
+from rag.speculation import ToolPrefetcher, _call_key, astream_with_prefetch
+
+
+def fake_tool(calls: list, name: str = "get_tle") -> StructuredTool:
+    """Async tool recording its calls, like `get_tle` it takes an integer NORAD id."""
+    async def run(norad_id: int) -> str:
+        calls.append(norad_id)
+        await asyncio.sleep(0)
+        return f"TLE {norad_id}"
+
+    return StructuredTool.from_function(coroutine=run, name=name, description="Fetches a TLE.")
+
+
+def tool_call(norad_id, call_id: str = "call-1") -> dict:
+    return {"name": "get_tle", "args": {"norad_id": norad_id}, "id": call_id}
+
+
+class FakeModel:
+    """Streams the given chunks and records, before each one, the calls already prefetched."""
+
+    def __init__(self, chunks: list[AIMessageChunk], thread_id: str):
+        self.chunks = chunks
+        self.thread_id = thread_id
+        self.pending_before_chunk = []
+        self.invoked = False
+
+    async def astream(self, messages):
+        for chunk in self.chunks:
+            await asyncio.sleep(0)
+            self.pending_before_chunk.append(len(speculation.prefetcher.pending.get(self.thread_id, {})))
+            yield chunk
+
+    async def ainvoke(self, messages):
+        self.invoked = True
+        return AIMessage(content="answer")
+
+
+def test_call_key_matches_the_parsed_arguments():
+    tool = fake_tool([])
+
+    assert _call_key(tool, {"norad_id": 25544.0}) == _call_key(tool, {"norad_id": 25544})
+    assert _call_key(tool, {"norad_id": 25544}) != _call_key(tool, {"norad_id": 25545})
+    assert _call_key(tool, {"norad_id": "not a number"}) is None
+
+
+def test_prefetched_result_is_handed_to_the_tool_node():
+    async def scenario():
+        calls = []
+        prefetcher = ToolPrefetcher()
+        wrapped = prefetcher.register(fake_tool(calls))
+
+        assert prefetcher.start("thread", "get_tle", {"norad_id": 25544.0})
+        prefetcher.settle("thread", AIMessage(content="", tool_calls=[tool_call(25544)]))
+        result = await wrapped.ainvoke({"norad_id": 25544}, config={"configurable": {"thread_id": "thread"}})
+        return calls, result, prefetcher.pending
+
+    calls, result, pending = asyncio.run(scenario())
+
+    # The tool ran once, for the prefetch
+    assert calls == [25544]
+    assert result == "TLE 25544"
+    assert not any(pending["thread"].values())
+
+
+def test_settle_cancels_the_calls_the_final_message_does_not_contain():
+    async def scenario():
+        prefetcher = ToolPrefetcher()
+        prefetcher.register(fake_tool([]))
+        prefetcher.start("thread", "get_tle", {"norad_id": 25544})
+        prefetcher.start("thread", "get_tle", {"norad_id": 48274})
+        tasks = {key: prefetches[0].task for key, prefetches in prefetcher.pending["thread"].items()}
+
+        prefetcher.settle("thread", AIMessage(content="", tool_calls=[tool_call(48274)]))
+        await asyncio.sleep(0)
+        return prefetcher, tasks
+
+    prefetcher, tasks = asyncio.run(scenario())
+    kept = prefetcher.tools["get_tle"]
+
+    assert list(prefetcher.pending["thread"]) == [_call_key(kept, {"norad_id": 48274})]
+    assert tasks[_call_key(kept, {"norad_id": 25544})].cancelled()
+
+
+def test_calls_start_once_their_arguments_are_complete(monkeypatch):
+    calls = []
+    prefetcher = ToolPrefetcher()
+    prefetcher.register(fake_tool(calls))
+    monkeypatch.setattr(speculation, "prefetcher", prefetcher)
+    model = FakeModel([
+        AIMessageChunk(content="", tool_call_chunks=[{"name": "get_tle", "args": '{"norad_', "id": "call-1", "index": 0}]),
+        AIMessageChunk(content="", tool_call_chunks=[{"name": None, "args": 'id": 25544}', "id": None, "index": 0}]),
+        AIMessageChunk(content=""),
+    ], thread_id="thread")
+
+    async def scenario():
+        message = await astream_with_prefetch(model, [HumanMessage(content="TLE of the ISS?")], {"configurable": {"thread_id": "thread"}})
+        await asyncio.sleep(0)
+        return message
+
+    message = asyncio.run(scenario())
+
+    # Nothing before the closing brace, then the call is running while the stream goes on
+    assert model.pending_before_chunk == [0, 0, 1]
+    assert calls == [25544]
+    assert message.tool_calls[0]["args"] == {"norad_id": 25544}
+    assert len(prefetcher.pending["thread"]) == 1
+
+
+def test_empty_stream_falls_back_to_invoke(monkeypatch):
+    prefetcher = ToolPrefetcher()
+    monkeypatch.setattr(speculation, "prefetcher", prefetcher)
+    model = FakeModel([], thread_id="thread")
+
+    message = asyncio.run(astream_with_prefetch(model, [HumanMessage(content="hi")], {"configurable": {"thread_id": "thread"}}))
+
+    assert model.invoked
+    assert message.content == "answer"
+    assert prefetcher.pending == {}